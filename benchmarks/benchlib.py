@@ -0,0 +1,209 @@
+# vim: set fileencoding=utf-8 :
+
+"""Shared helpers for the clipster benchmarks.
+
+Loads the clipster script as a module, builds daemons with temporary data
+dirs and (optionally) in-memory clipboards, generates synthetic histories
+and copy-event traces, and collects latency statistics.
+"""
+
+from __future__ import print_function
+import argparse
+import json
+import os
+import random
+import string
+import tempfile
+import time
+
+try:
+    timer = time.perf_counter
+except AttributeError:
+    # py 2.x
+    timer = time.time
+
+CLIPSTER = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "clipster")
+
+
+def load_clipster():
+    """Import the clipster script as a module."""
+
+    try:
+        # py >=3.5
+        import importlib.machinery
+        import importlib.util
+        loader = importlib.machinery.SourceFileLoader("clipster", CLIPSTER)
+        module = importlib.util.module_from_spec(importlib.util.spec_from_loader("clipster", loader))
+        loader.exec_module(module)
+        return module
+    except (ImportError, AttributeError):
+        import imp
+        return imp.load_source("clipster", CLIPSTER)
+
+
+clipster = load_clipster()
+
+
+class FakeClipboard(object):
+    """In-memory stand-in for a Gtk.Clipboard, so benchmarks don't need (or
+    measure) an X server."""
+
+    def __init__(self):
+        self.text = None
+
+    def set_text(self, text, _):
+        self.text = text
+
+    def clear(self):
+        self.text = None
+
+    def wait_for_text(self):
+        return self.text
+
+    def wait_for_targets(self):
+        return (self.text is not None, [])
+
+    def request_text(self, callback, *args):
+        callback(self, self.text, *args)
+
+    def request_targets(self, callback, *args):
+        callback(self, [], *args)
+
+
+def make_config(data_dir, **options):
+    """Return a clipster config using data_dir, with options overridden."""
+
+    config = clipster.parse_config(argparse.Namespace(config=None), data_dir, data_dir)
+    for key, value in options.items():
+        config.set('clipster', key, str(value))
+    return config
+
+
+def make_daemon(config, stub=True):
+    """Return a daemon, with in-memory clipboards if stub is set."""
+
+    daemon = clipster.Daemon(config)
+    if stub:
+        daemon.primary = FakeClipboard()
+        daemon.clipboard = FakeClipboard()
+    return daemon
+
+
+def temp_dir():
+    """Return a new temporary directory."""
+
+    return tempfile.mkdtemp(prefix="clipster-bench-")
+
+
+def random_text(rand, length):
+    """Return random 'words' of roughly length characters, over several lines."""
+
+    words = []
+    size = 0
+    while size < length:
+        word = ''.join(rand.choice(string.ascii_letters) for _ in range(rand.randint(1, 10)))
+        words.append(word)
+        size += len(word) + 1
+        if rand.random() < 0.05:
+            words.append('\n')
+    return ' '.join(words)[:length]
+
+
+def synthetic_history(size, length, seed=0):
+    """Return a list of size distinct random entries of about length characters."""
+
+    rand = random.Random(seed)
+    return ["{0} {1}".format(i, random_text(rand, max(1, int(rand.expovariate(1.0 / length)))))
+            for i in range(size)]
+
+
+def copy_trace(count, length, history, seed=0):
+    """Return a realistic list of (board, text) copy events.
+
+    Mixes new selections, re-selections of existing entries (duplicates),
+    selections grown a character at a time (smart update), and selections
+    containing URIs and emails (extraction)."""
+
+    rand = random.Random(seed)
+    events = []
+    while len(events) < count:
+        board = 'PRIMARY' if rand.random() < 0.7 else 'CLIPBOARD'
+        choice = rand.random()
+        if choice < 0.5:
+            events.append((board, random_text(rand, max(1, int(rand.expovariate(1.0 / length))))))
+        elif choice < 0.7 and history:
+            events.append((board, rand.choice(history)))
+        elif choice < 0.9:
+            # A selection drag: grows by one character per event
+            text = random_text(rand, rand.randint(10, 40))
+            for end in range(len(text) - rand.randint(3, 8), len(text) + 1):
+                events.append(('PRIMARY', text[:end]))
+        else:
+            events.append((board, "see https://example.com/{0} or mail user{0}@example.com {1}".format(
+                rand.randint(0, 10 ** 6), random_text(rand, 40))))
+    return events[:count]
+
+
+class Results(object):
+    """Collect per-operation timings, and report or compare them."""
+
+    def __init__(self):
+        self.timings = {}
+
+    def time(self, name, func, *args):
+        """Call func(*args), recording its duration under name."""
+
+        start = timer()
+        result = func(*args)
+        self.timings.setdefault(name, []).append(timer() - start)
+        return result
+
+    def summary(self):
+        """Return a dict of name -> statistics (times in microseconds)."""
+
+        summary = {}
+        for name, times in self.timings.items():
+            times = sorted(times)
+            total = sum(times)
+
+            def percentile(pct, times=times):
+                return times[min(len(times) - 1, int(len(times) * pct / 100.0))] * 1e6
+            summary[name] = {'count': len(times),
+                             'ops_per_sec': len(times) / total if total else 0,
+                             'p50': percentile(50), 'p90': percentile(90),
+                             'p99': percentile(99), 'max': times[-1] * 1e6}
+        return summary
+
+    def report(self):
+        """Print a table of results."""
+
+        print("{0:<36} {1:>7} {2:>12} {3:>10} {4:>10} {5:>10} {6:>10}".format(
+            "operation", "count", "ops/sec", "p50 us", "p90 us", "p99 us", "max us"))
+        for name, stats in sorted(self.summary().items()):
+            print("{0:<36} {count:>7} {ops_per_sec:>12.1f} {p50:>10.1f} {p90:>10.1f} {p99:>10.1f} {max:>10.1f}".format(name, **stats))
+
+    def save(self, path):
+        """Save results as a baseline."""
+
+        with open(path, 'w') as baseline:
+            json.dump(self.summary(), baseline, indent=1, sort_keys=True)
+
+    def compare(self, path, tolerance, stat='p50'):
+        """Compare results with a saved baseline, printing and returning regressions.
+
+        A regression is an operation whose stat is more than tolerance
+        (a fraction) slower than the baseline."""
+
+        with open(path) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = []
+        for name, stats in sorted(self.summary().items()):
+            if name not in baseline or not baseline[name][stat]:
+                continue
+            change = stats[stat] / baseline[name][stat] - 1
+            status = "REGRESSION" if change > tolerance else "ok"
+            print("{0:<32} {1:>10.1f} -> {2:>10.1f} us ({3:+.0%}) {4}".format(
+                name, baseline[name][stat], stats[stat], change, status))
+            if change > tolerance:
+                regressions.append(name)
+        return regressions
@@ -0,0 +1,214 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+"""Benchmark the clipster daemon's hot paths.
+
+Runs headless: by default the daemon's clipboards are replaced with
+in-memory stand-ins, so no X server is needed (although the GI modules
+must be installed). Use --gtk (e.g. under xvfb-run) to use real clipboards
+and also time the selection window.
+
+Measures, against a synthetic history of --size entries per board of about
+--length characters:
+
+* update_history, for new entries and a realistic copy-event trace
+* process_msg BOARD (latest entries and searches) and DELETE
+* write_history_file/read_history_file, for each history format
+* selection window population (or just its labels, without --gtk)
+* client request round-trip, over a socket pair
+
+Results are throughput and latency percentiles. Use --save to store them
+as a baseline, and --compare to fail (exit 1) if any operation's median
+latency has regressed by more than --tolerance.
+
+Usage: python benchmarks/daemon.py [-h] [--size N] [--length N] ...
+"""
+
+from __future__ import print_function
+import argparse
+import json
+import os
+import re
+import select
+import shutil
+import socket
+import sys
+
+from benchlib import clipster, copy_trace, make_config, make_daemon, Results, synthetic_history, temp_dir
+
+
+class NullConn(object):
+    """A connection which discards replies."""
+
+    def send(self, data):
+        return len(data)
+
+
+def history_daemon(args, data_dir, **options):
+    """Return a daemon with a synthetic history on both boards."""
+
+    options.setdefault('history_size', args.size * 2)
+    daemon = make_daemon(make_config(data_dir, **options), stub=not args.gtk)
+    daemon.read_history_file()
+    # Seed each board's history differently, but the same in every run
+    for index, board in enumerate(sorted(daemon.boards)):
+        for text in synthetic_history(args.size, args.length, seed=args.seed + index):
+            daemon.boards[board].append(text)
+    return daemon
+
+
+def bench_update_history(args, results, data_dir):
+    """update_history for new selections, and for a realistic trace."""
+
+    daemon = history_daemon(args, data_dir)
+    for board, text in copy_trace(args.events, args.length, [], seed=args.seed):
+        results.time('update_history.new', daemon.update_history, board, "new " + text)
+    history = list(daemon.boards['PRIMARY'])
+    for board, text in copy_trace(args.events, args.length, history, seed=args.seed + 1):
+        results.time('update_history.trace', daemon.update_history, board, text)
+
+
+def bench_process_msg(args, results, data_dir):
+    """process_msg BOARD, search and DELETE requests."""
+
+    daemon = history_daemon(args, data_dir)
+    client = clipster.ClientConnection(NullConn(), daemon.settings.max_input)
+    history = list(daemon.boards['PRIMARY'])
+
+    def request(msg):
+        daemon.process_msg(client, msg, True)
+        client.send()
+
+    requests = [
+        ('process_msg.board_1', {'count': 1}, None),
+        ('process_msg.board_50', {'count': 50}, None),
+        ('process_msg.board_all', {'count': 0}, None),
+        ('process_msg.search_literal', {'count': 0, 'mode': 'literal', 'icase': True}, 'abc'),
+        ('process_msg.search_regex', {'count': 10}, r'ab\w+c'),
+        ('process_msg.search_prefix', {'count': 0, 'mode': 'prefix'}, '12'),
+    ]
+    for name, header, content in requests:
+        header.update(action='BOARD', board='PRIMARY')
+        msg = json.dumps(header) + ('' if content is None else '\n' + content)
+        for _ in range(args.repeat if name != 'process_msg.board_all' else max(1, args.repeat // 10)):
+            results.time(name, request, msg)
+    for text in history[-args.repeat:]:
+        msg = json.dumps({'action': 'DELETE', 'board': 'PRIMARY', 'count': 0}) + '\n' + text
+        results.time('process_msg.delete', request, msg)
+
+
+def bench_history_files(args, results, data_dir):
+    """write_history_file and read_history_file, in each format."""
+
+    for history_format in ('json', 'journal', 'indexed'):
+        fmt_dir = os.path.join(data_dir, history_format)
+        os.mkdir(fmt_dir)
+        daemon = history_daemon(args, fmt_dir, history_format=history_format)
+        daemon.update_history_file = True
+        results.time('write_history_file.{0}.initial'.format(history_format), daemon.write_history_file)
+        for board, text in copy_trace(args.repeat, args.length, [], seed=args.seed):
+            daemon.update_history(board, text)
+            daemon.update_history_file = True
+            results.time('write_history_file.{0}.change'.format(history_format), daemon.write_history_file)
+        if daemon.journal:
+            daemon.journal.finish_compaction(wait=True)
+        for _ in range(max(1, args.repeat // 20)):
+            reader = make_daemon(daemon.config, stub=not args.gtk)
+            results.time('read_history_file.{0}'.format(history_format), reader.read_history_file)
+
+
+def bench_picker(args, results, data_dir):
+    """Selection window population (or just label generation, if stubbed)."""
+
+    daemon = history_daemon(args, data_dir)
+    if not args.gtk:
+        row_height = daemon.config.getint('clipster', 'row_height')
+        for entry_id in daemon.boards['PRIMARY'].entry_ids(reverse=True):
+            results.time('picker.label', clipster.make_label,
+                         daemon.boards['PRIMARY'].get(entry_id), row_height)
+        return
+    gtk = clipster.Gtk
+
+    def populate():
+        daemon.selection_widget('PRIMARY')
+        while daemon.picker['position'] < len(daemon.picker['entry_ids']):
+            gtk.main_iteration_do(False)
+        daemon.hide_picker()
+
+    for _ in range(max(1, args.repeat // 20)):
+        results.time('picker.populate', populate)
+
+
+def bench_roundtrip(args, results, data_dir):
+    """Client requests over a socket pair, processed by the daemon's socket handlers."""
+
+    daemon = history_daemon(args, data_dir)
+    client, server = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    daemon.client_msgs[server.fileno()] = clipster.ClientConnection(server, daemon.settings.max_input)
+
+    def request(data):
+        client.sendall(data)
+        while not select.select([client], [], [], 0)[0]:
+            daemon.socket_recv(server, None)
+        return clipster.recv_frame(client)
+
+    requests = [('roundtrip.board_1', clipster.encode_request('BOARD', 'PRIMARY', 1)),
+                ('roundtrip.search', clipster.encode_request('BOARD', 'PRIMARY', 10, 'abc', mode='literal')),
+                ('roundtrip.send', clipster.encode_request('SEND', 'CLIPBOARD', 0, 'x' * args.length)),
+                ('roundtrip.ignore', clipster.encode_request('IGNORE', 'PRIMARY'))]
+    for name, data in requests:
+        for _ in range(args.repeat):
+            results.time(name, request, data)
+    client.close()
+    server.close()
+
+
+BENCHMARKS = [bench_update_history, bench_process_msg, bench_history_files, bench_picker, bench_roundtrip]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Clipster daemon benchmarks.")
+    parser.add_argument('--size', type=int, default=5000,
+                        help="Number of history entries per board (default 5000).")
+    parser.add_argument('--length', type=int, default=200,
+                        help="Mean entry length in characters (default 200).")
+    parser.add_argument('--events', type=int, default=2000,
+                        help="Number of copy events to replay (default 2000).")
+    parser.add_argument('--repeat', type=int, default=200,
+                        help="Number of repetitions of each request (default 200).")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="Random seed for generated histories and traces.")
+    parser.add_argument('--gtk', action='store_true',
+                        help="Use real Gtk clipboards and time the selection window (needs X, e.g. xvfb-run).")
+    parser.add_argument('--only', action='store',
+                        help="Only run benchmarks whose name matches this regex.")
+    parser.add_argument('--save', action='store', metavar='FILE',
+                        help="Save results to FILE as a baseline.")
+    parser.add_argument('--compare', action='store', metavar='FILE',
+                        help="Compare results with a baseline FILE, exiting 1 on regressions.")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="Allowed fractional slowdown of median latency (default 0.25).")
+    args = parser.parse_args()
+
+    results = Results()
+    for bench in BENCHMARKS:
+        name = bench.__name__[len('bench_'):]
+        if args.only and not re.search(args.only, name):
+            continue
+        print("Running {0}...".format(name), file=sys.stderr)
+        data_dir = temp_dir()
+        try:
+            bench(args, results, data_dir)
+        finally:
+            shutil.rmtree(data_dir)
+    results.report()
+    if args.save:
+        results.save(args.save)
+    if args.compare:
+        print()
+        if results.compare(args.compare, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
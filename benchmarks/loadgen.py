@@ -0,0 +1,181 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+"""Generate concurrent client load against the clipster daemon.
+
+Runs --clients concurrent clients, each making --requests requests (on a
+new connection each time, like the clipster client): a mix of streamed
+BOARD requests for the whole history (as `clipster -o -n 0` does), SENDs
+and STATS.
+
+By default a daemon is started in-process, with a synthetic history and
+in-memory clipboards (so no X server is needed, although the GI modules
+must be installed). Simulated clipboard events are fed to it every
+--event-interval ms while the clients run, and the delay before each is
+handled is measured: this shows whether client load starves clipboard
+events. Use --socket to load a running daemon instead.
+
+Reports request latencies and throughput, event delays, and the number of
+failed requests.
+
+Usage: python benchmarks/loadgen.py [-h] [--clients N] [--requests N] ...
+"""
+
+from __future__ import print_function
+import argparse
+import os
+import random
+import shutil
+import socket
+import sys
+import threading
+
+from benchlib import clipster, make_config, make_daemon, Results, synthetic_history, temp_dir, timer
+
+
+def request(path, data, timeout):
+    """Connect to the daemon, send a request and read the whole reply."""
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        # Connect in blocking mode (as the client does): with a timeout, a
+        # full listen backlog fails immediately, rather than waiting
+        sock.connect(path)
+        sock.settimeout(timeout)
+        sock.sendall(data)
+        while True:
+            frame = clipster.recv_frame(sock)
+            if frame is None:
+                raise clipster.ClipsterError("Connection closed by daemon.")
+            if frame[0] != clipster.FRAME_RECORD:
+                return
+    finally:
+        sock.close()
+
+
+def run_client(args, path, results, errors, seed):
+    """Make args.requests requests, recording their latencies."""
+
+    rand = random.Random(seed)
+    requests = [('request.stream_all', clipster.encode_request('BOARD', 'PRIMARY', 0, stream=True)),
+                ('request.send', None),
+                ('request.stats', clipster.encode_request('STATS', 'PRIMARY'))]
+    for _ in range(args.requests):
+        choice = rand.random()
+        name, data = requests[0 if choice < args.stream_ratio else 1 if choice < 0.9 else 2]
+        if data is None:
+            data = clipster.encode_request('SEND', 'CLIPBOARD', 0, "load {0}".format(rand.random()))
+        try:
+            results.time(name, request, path, data, args.timeout)
+        except (socket.error, clipster.ClipsterError) as exc:
+            errors.append("{0}: {1}".format(name, exc))
+
+
+def run_clients(args, path, results, errors):
+    """Run the clients in threads, returning once they have all finished."""
+
+    threads = [threading.Thread(target=run_client, args=(args, path, results, errors, args.seed + i))
+               for i in range(args.clients)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def start_daemon(args, data_dir):
+    """Return a daemon listening on a socket in data_dir, with a synthetic history."""
+
+    config = make_config(data_dir, pid_file=os.path.join(data_dir, 'clipster.pid'),
+                         history_size=args.size, max_clients=args.max_clients,
+                         socket_backlog=args.backlog)
+    daemon = make_daemon(config)
+    daemon.read_history_file()
+    for text in synthetic_history(args.size, args.length, seed=args.seed):
+        daemon.boards['PRIMARY'].append(text)
+    daemon.prepare_files()
+    daemon.accept_watch = clipster.GObject.io_add_watch(daemon.sock, clipster.GObject.IO_IN,
+                                                        daemon.socket_accept)
+    return daemon
+
+
+def run_in_process(args, results, errors):
+    """Load an in-process daemon, timing simulated clipboard events meanwhile."""
+
+    data_dir = temp_dir()
+    try:
+        daemon = start_daemon(args, data_dir)
+        loop = clipster.GLib.MainLoop()
+        rand = random.Random(args.seed)
+        interval = args.event_interval / 1000.0
+        due = [timer() + interval]
+
+        def clipboard_event():
+            now = timer()
+            results.timings.setdefault('event.delay', []).append(max(0, now - due[0]))
+            due[0] = now + interval
+            board = rand.choice(('PRIMARY', 'CLIPBOARD'))
+            results.time('event.update_history', daemon.update_history, board, "event {0}".format(rand.random()))
+            return True
+
+        def clients():
+            run_clients(args, daemon.sock_file, results, errors)
+            clipster.GLib.idle_add(loop.quit)
+
+        clipster.GLib.timeout_add(args.event_interval, clipboard_event)
+        thread = threading.Thread(target=clients)
+        thread.daemon = True
+        thread.start()
+        loop.run()
+        daemon.sock.close()
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Clipster daemon load generator.")
+    parser.add_argument('--clients', type=int, default=200,
+                        help="Number of concurrent clients (default 200).")
+    parser.add_argument('--requests', type=int, default=20,
+                        help="Number of requests made by each client (default 20).")
+    parser.add_argument('--stream-ratio', type=float, default=0.5,
+                        help="Fraction of requests which stream the whole history (default 0.5).")
+    parser.add_argument('--timeout', type=float, default=30,
+                        help="Seconds to wait for each request before failing it (default 30).")
+    parser.add_argument('--socket', action='store',
+                        help="Load the daemon listening on this socket, rather than starting one.")
+    parser.add_argument('--size', type=int, default=500,
+                        help="Number of history entries, for the in-process daemon (default 500).")
+    parser.add_argument('--length', type=int, default=200,
+                        help="Mean entry length in characters (default 200).")
+    parser.add_argument('--max-clients', type=int, default=256,
+                        help="max_clients, for the in-process daemon (default 256).")
+    parser.add_argument('--backlog', type=int, default=128,
+                        help="socket_backlog, for the in-process daemon (default 128).")
+    parser.add_argument('--event-interval', type=int, default=20,
+                        help="Interval (ms) between simulated clipboard events (default 20).")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="Random seed for requests and the generated history.")
+    args = parser.parse_args()
+
+    results = Results()
+    errors = []
+    start = timer()
+    if args.socket:
+        run_clients(args, args.socket, results, errors)
+    else:
+        run_in_process(args, results, errors)
+    elapsed = timer() - start
+    results.report()
+    total = sum(len(x) for name, x in results.timings.items() if name.startswith('request.'))
+    print()
+    print("{0} requests from {1} clients in {2:.1f}s ({3:.0f} requests/sec), {4} failed.".format(
+        total + len(errors), args.clients, elapsed, total / elapsed, len(errors)))
+    for error in sorted(set(errors))[:10]:
+        print("  " + error)
+    if errors:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
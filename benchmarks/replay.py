@@ -0,0 +1,239 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+"""Replay a clipster trace through the daemon, optionally profiling it.
+
+A trace is recorded by the daemon when trace_file is set in the config
+(see the README). Selections are fed to update_history, and client
+requests are sent over a socket pair and processed by the daemon's socket
+handlers, as fast as possible or at --speed times the recorded rate.
+
+Traces recorded without trace_content only contain the size and digest of
+each selection: they are replayed with generated text of the same size
+(the same for each digest, so duplicates are still duplicates, although
+the overlap between successive selections which smart_update looks for is
+lost). Requests are replayed as framed requests, whichever protocol the
+client used, and SELECT requests (which open the selection window) are
+skipped.
+
+The daemon is headless (in-memory clipboards, so no X server is needed,
+although the GI modules must be installed), with a temporary data dir and
+the config in --config (so the options and patterns files match the
+recording), starting with --history or a synthetic history of --size
+entries. The history is written (if changed) every history_update_interval
+seconds of trace time, as the daemon would.
+
+Use --profile to run under cProfile, and --tracemalloc to report the
+largest allocations.
+
+Usage: python benchmarks/replay.py [-h] [--speed N] [--profile FILE] ... TRACE
+"""
+
+from __future__ import print_function
+import argparse
+import cProfile
+import json
+import pstats
+import random
+import select
+import shutil
+import socket
+import sys
+import time
+
+from benchlib import clipster, make_config, make_daemon, random_text, Results, synthetic_history, temp_dir, timer
+
+try:
+    import tracemalloc
+except ImportError:
+    # py 2.x
+    tracemalloc = None
+
+
+def read_trace(path):
+    """Return a trace's selection and request events, with times running on across restarts."""
+
+    events = []
+    offset = end = 0
+    with open(path, 'rb') as trace:
+        for lineno, line in enumerate(trace, 1):
+            try:
+                event = json.loads(line.decode('utf-8'))
+            except ValueError:
+                print("Skipping invalid event on line {0}".format(lineno), file=sys.stderr)
+                continue
+            if event['event'] == 'start':
+                offset = end
+            else:
+                event['t'] += offset
+                end = event['t']
+                events.append(event)
+    return events
+
+
+def event_text(event):
+    """Return an event's content, or generated text of the same size if it wasn't recorded."""
+
+    if 'text' in event:
+        return event['text']
+    if 'digest' not in event:
+        return None
+    return random_text(random.Random(event['digest']), event['size'])
+
+
+class Replayer(object):
+    """Feeds trace events to a daemon, through its socket handlers for requests."""
+
+    def __init__(self, daemon, results):
+        self.daemon = daemon
+        self.results = results
+        self.sock, self.server = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.setblocking(False)
+        daemon.client_msgs[self.server.fileno()] = clipster.ClientConnection(self.server, daemon.settings.max_input)
+        self.skipped = 0
+
+    def request(self, data):
+        """Send a request, and read the whole reply.
+
+        The daemon's socket handler is called whenever there is no reply
+        data to read, as the main loop would call it for a real client."""
+
+        self.sock.sendall(data)
+        buf = bytearray()
+        while True:
+            if not select.select([self.sock], [], [], 0)[0]:
+                self.daemon.socket_recv(self.server, None)
+                continue
+            data = self.sock.recv(65536)
+            if not data:
+                raise clipster.ClipsterError("Connection closed by daemon.")
+            buf.extend(data)
+            # Drop complete frames, until the end of the reply
+            while len(buf) >= clipster.FRAME.size:
+                _, kind, length = clipster.FRAME.unpack(bytes(buf[:clipster.FRAME.size]))
+                if len(buf) < clipster.FRAME.size + length:
+                    break
+                del buf[:clipster.FRAME.size + length]
+                if kind != clipster.FRAME_RECORD:
+                    return
+
+    def replay(self, event):
+        """Replay one event."""
+
+        text = event_text(event)
+        if event['event'] == 'selection':
+            self.results.time('replay.selection', self.daemon.update_history, event['board'], text)
+        elif event['action'] == 'SELECT':
+            self.skipped += 1
+        else:
+            data = clipster.encode_request(event['action'], event['board'], event['count'], text, **event['options'])
+            self.results.time('replay.request.{0}'.format(event['action']), self.request, data)
+
+    def close(self):
+        """Close the connection."""
+
+        self.sock.close()
+        self.server.close()
+
+
+def run(args, events, results, data_dir):
+    """Replay events through a daemon, in data_dir."""
+
+    config = make_config(data_dir)
+    if args.config:
+        config = clipster.parse_config(argparse.Namespace(config=args.config), data_dir, args.config)
+        # Keep the daemon's files in data_dir, and don't trace the replay
+        config.set('clipster', 'data_dir', data_dir)
+        for option in ('history_file', 'journal_file', 'indexed_file', 'trace_file'):
+            config.remove_option('clipster', option)
+    if args.history:
+        history_format = config.get('clipster', 'history_format')
+        shutil.copy(args.history, config.get('clipster', {'journal': 'journal_file', 'indexed': 'indexed_file'}.get(
+            history_format, 'history_file')))
+    daemon = make_daemon(config)
+    daemon.read_history_file()
+    for text in synthetic_history(args.size, args.length, seed=args.seed):
+        daemon.boards['PRIMARY'].append(text)
+    daemon.load_patterns()
+    interval = config.getint('clipster', 'history_update_interval')
+    replayer = Replayer(daemon, results)
+    start = timer()
+    last_write = 0
+    for event in events:
+        if args.speed:
+            delay = start + event['t'] / args.speed - timer()
+            if delay > 0:
+                time.sleep(delay)
+        replayer.replay(event)
+        if interval and event['t'] - last_write >= interval:
+            last_write = event['t']
+            results.time('replay.write_history_file', daemon.write_history_file)
+    replayer.close()
+    for pool in (daemon.pattern_pool, daemon.io_pool):
+        if pool:
+            pool.drain()
+            pool.stop()
+    for worker in daemon.pattern_workers:
+        worker.stop()
+    return replayer.skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a clipster trace through the daemon.")
+    parser.add_argument('trace', help="Trace file, recorded by the daemon (see trace_file).")
+    parser.add_argument('--speed', type=float, default=0,
+                        help="Replay at N times the recorded rate (default 0: as fast as possible).")
+    parser.add_argument('--config', action='store', metavar='DIR',
+                        help="Use the config (and patterns files) in DIR.")
+    parser.add_argument('--history', action='store', metavar='FILE',
+                        help="Start with this history file (in the config's history_format).")
+    parser.add_argument('--size', type=int, default=0,
+                        help="Add this many synthetic entries to the history first (default 0).")
+    parser.add_argument('--length', type=int, default=200,
+                        help="Mean synthetic entry length in characters (default 200).")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="Random seed for the synthetic history.")
+    parser.add_argument('--profile', action='store', metavar='FILE',
+                        help="Profile the replay with cProfile, saving the stats to FILE.")
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help="Trace memory allocations, reporting the largest and the peak.")
+    parser.add_argument('--top', type=int, default=25,
+                        help="Number of profile functions or allocation sites to report (default 25).")
+    args = parser.parse_args()
+
+    events = read_trace(args.trace)
+    results = Results()
+    profiler = cProfile.Profile() if args.profile else None
+    if args.tracemalloc:
+        if tracemalloc is None:
+            parser.error("tracemalloc requires python 3.4+")
+        tracemalloc.start()
+    data_dir = temp_dir()
+    try:
+        if profiler:
+            profiler.enable()
+        skipped = run(args, events, results, data_dir)
+        if profiler:
+            profiler.disable()
+        if args.tracemalloc:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+    finally:
+        shutil.rmtree(data_dir)
+    results.report()
+    print()
+    print("Replayed {0} events ({1} skipped).".format(len(events) - skipped, skipped))
+    if profiler:
+        profiler.dump_stats(args.profile)
+        print()
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(args.top)
+    if args.tracemalloc:
+        print()
+        print("Peak traced memory: {0:.1f} KiB".format(peak / 1024.0))
+        for stat in snapshot.statistics('lineno')[:args.top]:
+            print(stat)
+
+
+if __name__ == "__main__":
+    main()
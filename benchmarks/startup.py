@@ -0,0 +1,91 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+"""Measure clipster client startup time.
+
+Client commands (-o, -i, SEND etc) only import stdlib modules - the GI
+stack is imported when the daemon starts. This compares the time taken to
+start the client with the time taken to import the GI modules, which every
+client invocation previously paid for.
+
+Usage: python benchmarks/startup.py [-n RUNS]
+"""
+
+from __future__ import print_function
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+CLIPSTER = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "clipster")
+
+# Load clipster as a module and report whether any GI module was imported
+CHECK_GI = """
+import sys, imp
+imp.load_source('clipster', {0!r})
+print('gi' in sys.modules)
+""".format(CLIPSTER)
+
+CHECK_GI_PY3 = """
+import sys, importlib.machinery, importlib.util
+loader = importlib.machinery.SourceFileLoader('clipster', {0!r})
+module = importlib.util.module_from_spec(importlib.util.spec_from_loader('clipster', loader))
+loader.exec_module(module)
+print('gi' in sys.modules)
+""".format(CLIPSTER)
+
+IMPORT_GI = """
+from gi import require_version
+require_version("Gtk", "3.0")
+from gi.repository import Gtk, Gdk, GLib, GObject
+"""
+
+
+def run(cmd, runs):
+    """Run cmd repeatedly, returning a sorted list of wall-clock times (ms)."""
+
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(runs):
+            start = time.time()
+            ret = subprocess.call(cmd, stdout=devnull, stderr=devnull)
+            times.append((time.time() - start) * 1000)
+            if ret:
+                return None
+    return sorted(times)
+
+
+def report(name, times):
+    """Print min/median/max of a list of times."""
+
+    if times is None:
+        print("{0:<28} unavailable".format(name))
+    else:
+        print("{0:<28} min {1:7.1f}ms  median {2:7.1f}ms  max {3:7.1f}ms".format(
+            name, times[0], times[len(times) // 2], times[-1]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Clipster client startup benchmark.")
+    parser.add_argument('-n', '--runs', type=int, default=20,
+                        help="Number of runs of each command (default 20).")
+    args = parser.parse_args()
+
+    check = CHECK_GI_PY3 if sys.version_info.major == 3 else CHECK_GI
+    gi_loaded = subprocess.check_output([sys.executable, '-c', check]).strip()
+    print("GI imported by client: {0}".format(gi_loaded.decode('utf-8')))
+
+    python = run([sys.executable, '-c', 'pass'], args.runs)
+    client = run([sys.executable, CLIPSTER, '--help'], args.runs)
+    gi_import = run([sys.executable, '-c', IMPORT_GI], args.runs)
+    report("python startup", python)
+    report("clipster client (--help)", client)
+    report("GI import (daemon only)", gi_import)
+    if client and gi_import:
+        print("Client startup would be ~{0:.0f}% slower with GI imported.".format(
+            100.0 * (gi_import[len(gi_import) // 2] - python[len(python) // 2]) / client[len(client) // 2]))
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,12 @@ import os
 import errno
 import logging
 import json
+import shutil
+import io
+import tempfile
+import time
+import re
+import socket
 from gi import require_version
 require_version("Gtk", "3.0")
 from gi.repository import Gtk, Gdk
@@ -44,6 +50,39 @@ except ImportError:
     import __builtin__ as builtins
 
 
+def frame_chunks(payload):
+    """Return a framed reply as the list of chunks recv will return."""
+
+    return [clipster.FRAME.pack(clipster.PROTOCOL_VERSION, clipster.FRAME_MSG, len(payload)), payload]
+
+
+def mock_stream(conn, data):
+    """Make a mock connection's recv/recv_into read from data, and return
+    a buffer which its send writes to."""
+
+    stream = io.BytesIO(data)
+    conn.recv.side_effect = stream.read
+    conn.recv_into.side_effect = stream.readinto
+    output = io.BytesIO()
+    conn.send.side_effect = output.write
+    return output
+
+
+def mock_client():
+    """Return a daemon's ClientConnection on a mock socket, and a function
+    which sends its output and returns the frames sent."""
+
+    conn = mock.MagicMock()
+    output = mock_stream(conn, b'')
+    client = clipster.ClientConnection(conn, 50000)
+
+    def frames():
+        client.send()
+        return list(clipster.read_frames(io.BytesIO(output.getvalue())))
+
+    return client, frames
+
+
 class ClipsterTestCase(unittest.TestCase):
     """Test the 'global' classes/methods of Clipster."""
 
@@ -67,6 +106,314 @@ class ClipsterTestCase(unittest.TestCase):
             raise clipster.ClipsterError()
 
 
+class HistoryTestCase(unittest.TestCase):
+    """Test the indexed History store."""
+
+    def setUp(self):
+        self.history = clipster.History(["ape", "bear", "cat", "bear"])
+
+    def test_list_behaviour(self):
+        """History should behave like the list it replaces."""
+
+        self.assertEqual(len(self.history), 4)
+        self.assertEqual(self.history, ["ape", "bear", "cat", "bear"])
+        self.assertEqual(self.history[-1], "bear")
+        self.assertEqual(self.history[0], "ape")
+        self.assertEqual(self.history[-2:], ["cat", "bear"])
+        self.assertTrue("cat" in self.history)
+        self.assertFalse("dog" in self.history)
+
+    def test_remove_oldest_duplicate(self):
+        """remove() should only remove the oldest matching entry."""
+
+        self.history.remove("bear")
+        self.assertEqual(self.history, ["ape", "cat", "bear"])
+        self.assertTrue("bear" in self.history)
+        self.history.remove("bear")
+        self.assertFalse("bear" in self.history)
+        with self.assertRaises(ValueError):
+            self.history.remove("bear")
+
+    def test_move_to_end(self):
+        """move_to_end() should make an existing entry the most recent."""
+
+        self.history.move_to_end("ape")
+        self.assertEqual(self.history, ["bear", "cat", "bear", "ape"])
+
+    def test_insert_before_last(self):
+        """insert_before_last() should keep the latest entry at the end."""
+
+        self.history.insert_before_last("dog")
+        self.assertEqual(self.history, ["ape", "bear", "cat", "dog", "bear"])
+
+    def test_search(self):
+        """search() should match in each mode, newest first."""
+
+        self.history.append("Bearing")
+        self.assertEqual(self.history.search("ear"), ["Bearing", "bear", "bear"])
+        self.assertEqual(self.history.search("ear", count=1), ["Bearing"])
+        self.assertEqual(self.history.search("be", mode="prefix"), ["bear", "bear"])
+        self.assertEqual(self.history.search("be", mode="prefix", icase=True), ["Bearing", "bear", "bear"])
+        self.assertEqual(self.history.search("r.n", mode="literal"), [])
+        self.assertEqual(self.history.search("r.n"), ["Bearing"])
+        self.assertEqual(self.history.search("BEAR", mode="literal", icase=True), ["Bearing", "bear", "bear"])
+        self.history.remove("bear")
+        self.assertEqual(self.history.search("bea"), ["bear"])
+        with self.assertRaises(ValueError):
+            self.history.search("bear", mode="fuzzy")
+
+    def test_required_literal(self):
+        """required_literal() should only return text every match must contain."""
+
+        self.assertEqual(clipster.required_literal(r'foo\.ba?r'), 'foo.b')
+        self.assertEqual(clipster.required_literal('(abc)?de{2}f'), 'd')
+        self.assertEqual(clipster.required_literal('[xyz]+abc'), 'abc')
+        self.assertEqual(clipster.required_literal('abc|def'), '')
+        # Escaped and leading ']' don't end a class
+        self.assertEqual(clipster.required_literal(r'[\]x]abc'), 'abc')
+        self.assertEqual(clipster.required_literal(r'[^\]]abc'), 'abc')
+        self.assertEqual(clipster.required_literal('[^]]abc'), 'abc')
+        history = clipster.History(["]abc", "xabc"])
+        self.assertEqual(history.search(r'[\]x]abc'), ["xabc", "]abc"])
+        self.assertEqual(history.search(r'[^\]]abc'), ["xabc"])
+        self.assertEqual(history.search('[^]]abc'), ["xabc"])
+
+    def test_required_literal_escapes(self):
+        """Searches with character code escapes and backreferences find the entries re.search does."""
+
+        texts = ["Abcd xyz", "AAbcd", "]]bcd", "101bcd", "x41bcd", "\0bcd", "\x08bcd"]
+        history = clipster.History(texts)
+        for pattern in (r'\x41bcd', r'\101bcd', r'\u0041bcd', r'\U00000041bcd', r'\N{LATIN CAPITAL LETTER A}bcd',
+                        r'(A)\1bcd', r'\0bcd', r'\010bcd', r'[\x5d]\x5dbcd', r'\d{3}bcd'):
+            expected = [x for x in reversed(texts) if re.search(pattern, x)]
+            self.assertEqual(history.search(pattern), expected, pattern)
+        self.assertEqual(clipster.required_literal(r'\x41bcd'), 'bcd')
+        self.assertEqual(clipster.required_literal(r'\101bcd'), 'bcd')
+
+    def test_search_casefold(self):
+        """Literal searches should find text whose lower-case form depends on context."""
+
+        history = clipster.History([u"\u0391\u0391\u03a3\u0391"])
+        self.assertEqual(history.search(u"\u0391\u0391\u03a3", mode="literal"), [u"\u0391\u0391\u03a3\u0391"])
+        self.assertEqual(history.search(u"\u03b1\u03b1\u03c2", mode="literal", icase=True), [u"\u0391\u0391\u03a3\u0391"])
+
+    def test_entry_ids(self):
+        """entry_ids() and get() should give access to entries by id."""
+
+        ids = self.history.entry_ids(reverse=True)
+        self.assertEqual([self.history.get(x) for x in ids], ["bear", "cat", "bear", "ape"])
+        self.history.pop()
+        with self.assertRaises(KeyError):
+            self.history.get(ids[0])
+
+    def test_latest(self):
+        """latest() returns the newest entries first."""
+
+        self.assertEqual(self.history.latest(2), ["bear", "cat"])
+        self.assertEqual(self.history.latest(0), ["bear", "cat", "bear", "ape"])
+        self.assertEqual(self.history.pop(), "bear")
+        self.assertEqual(self.history.latest(1), ["cat"])
+
+
+class BlobStoreTestCase(unittest.TestCase):
+    """Test the content-addressed store shared by histories."""
+
+    def test_shared_content(self):
+        """Content is stored once, and released when no history holds it."""
+
+        store = clipster.BlobStore()
+        primary = clipster.History(["ape", "bear"], store=store)
+        clipboard = clipster.History(["bear", "bear"], store=store)
+        self.assertEqual(len(store), 2)
+        clipboard.clear()
+        self.assertEqual(len(store), 2)
+        primary.remove("bear")
+        self.assertEqual(len(store), 1)
+        self.assertEqual(store.counters()['bytes'], 3)
+
+    def test_compression(self):
+        """Content over the threshold is compressed, and decompressed on access."""
+
+        store = clipster.BlobStore(compress_threshold=100)
+        history = clipster.History(["small", "caf\u00e9 " * 100], store=store)
+        self.assertEqual(store.compressed, 1)
+        self.assertTrue(store.compressed_size < 100)
+        self.assertEqual(history[-1], "caf\u00e9 " * 100)
+        self.assertEqual(history.search("\u00e9 c", mode='literal'), ["caf\u00e9 " * 100])
+        history.pop()
+        self.assertEqual(store.counters(), {'blobs': 1, 'bytes': 5, 'mapped': 0, 'compressed': 0, 'compressed_bytes': 0})
+
+
+class HistoryBudgetTestCase(unittest.TestCase):
+    """Test History's memory budget and eviction policies."""
+
+    def setUp(self):
+        self.history = clipster.History(["a" * 10, "b" * 40, "c" * 10, "caf\u00e9"])
+        self.changes = []
+        self.history.listeners.append(lambda op, arg: self.changes.append(op))
+
+    def test_size(self):
+        """size is the total UTF-8 encoded size of the entries."""
+
+        self.assertEqual(self.history.size, 65)
+        self.history.pop()
+        self.assertEqual(self.history.size, 60)
+        self.history.clear()
+        self.assertEqual(self.history.size, 0)
+
+    def test_evict_oldest(self):
+        """The oldest entries are evicted first."""
+
+        self.assertEqual(self.history.set_budget(55), 1)
+        self.assertEqual(self.history, ["b" * 40, "c" * 10, "caf\u00e9"])
+        self.history.append("d" * 10)
+        self.assertEqual(self.history, ["c" * 10, "caf\u00e9", "d" * 10])
+        self.assertEqual(self.history.evicted, 2)
+        # Evictions are reported to listeners, so they are journalled
+        self.assertEqual(self.changes, ['remove', 'add', 'remove'])
+
+    def test_evict_largest(self):
+        """The largest entries are evicted first."""
+
+        self.history.set_budget(30, 'largest')
+        self.assertEqual(self.history, ["a" * 10, "c" * 10, "caf\u00e9"])
+        # The newest entry is the largest, so the oldest of the next largest is evicted
+        self.history.append("d" * 12)
+        self.assertEqual(self.history, ["c" * 10, "caf\u00e9", "d" * 12])
+
+    def test_largest_heap_bounded(self):
+        """Removed entries don't accumulate in the largest-first heap."""
+
+        history = clipster.History(["same text"], policy='largest')
+        for _ in range(1000):
+            history.move_to_end("same text")
+        self.assertEqual(len(history), 1)
+        self.assertTrue(len(history._largest) <= 2)
+
+    def test_evict_lru(self):
+        """The least recently selected entries are evicted first."""
+
+        self.history.set_budget(0, 'lru')
+        self.history.touch(self.history.entry_ids()[0])
+        self.history.set_budget(55, 'lru')
+        self.assertEqual(self.history, ["a" * 10, "c" * 10, "caf\u00e9"])
+
+    def test_newest_kept(self):
+        """The most recent entry is never evicted, even if it is over budget."""
+
+        self.history.set_budget(30, 'largest')
+        self.history.append("e" * 50)
+        self.assertEqual(self.history, ["e" * 50])
+
+    def test_invalid_policy(self):
+        """Unknown policies raise ValueError."""
+
+        with self.assertRaises(ValueError):
+            self.history.set_budget(10, 'random')
+
+
+class StatsTestCase(unittest.TestCase):
+    """Test the daemon's counters and latency histograms."""
+
+    def test_report(self):
+        """Latencies are bucketed by powers of two microseconds."""
+
+        stats = clipster.Stats()
+        for seconds in (0.000003, 0.000003, 0.000003, 0.0001):
+            stats.record('op', seconds)
+        stats.count('events')
+        stats.count('events', 2)
+        report = stats.report(boards={'PRIMARY': 1})
+        self.assertEqual(report['counters'], {'events': 3})
+        self.assertEqual(report['boards'], {'PRIMARY': 1})
+        timing = report['timings']['op']
+        self.assertEqual(timing['count'], 4)
+        self.assertEqual(timing['histogram'], [[4, 3], [128, 1]])
+        self.assertEqual(timing['p50_us'], 4)
+        self.assertAlmostEqual(timing['p99_us'], 100)
+
+    def test_timer(self):
+        """timer() records its block, even if it raises."""
+
+        stats = clipster.Stats()
+        with self.assertRaises(ValueError):
+            with stats.timer('op'):
+                raise ValueError()
+        self.assertEqual(stats.report()['timings']['op']['count'], 1)
+
+
+class SlowTarget(object):
+    """Target for WorkerProcess tests."""
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+        return seconds
+
+    def fail(self):
+        raise ValueError("failed")
+
+
+class WorkerTestCase(unittest.TestCase):
+    """Test the worker thread pool and worker processes."""
+
+    def setUp(self):
+        # Pools deliver callbacks with GLib.idle_add
+        clipster.load_gi()
+
+    def test_pool_order(self):
+        """Callbacks are called in the order tasks are submitted, with any error raised."""
+
+        pool = clipster.WorkerPool(3)
+        self.addCleanup(pool.stop)
+        results = []
+        for delay in (0.05, 0, 0.02):
+            pool.submit(SlowTarget().sleep, (delay,), lambda result, error: results.append(result))
+        pool.submit(SlowTarget().fail, callback=lambda result, error: results.append(str(error)))
+        pool.drain()
+        self.assertEqual(results, [0.05, 0, 0.02, "failed"])
+        self.assertEqual(pool.pending(), 0)
+
+    def test_pool_full(self):
+        """Tasks submitted once the queue is full fail, rather than blocking."""
+
+        pool = clipster.WorkerPool(1, max_pending=1)
+        self.addCleanup(pool.stop)
+        results = []
+        with mock.patch.object(clipster, 'GLib'):
+            for delay in (0.1, 0, 0):
+                pool.submit(SlowTarget().sleep, (delay,), lambda result, error: results.append(error or result))
+                # Wait for the (only) thread to start the first task
+                while not pool.tasks.empty() and delay:
+                    time.sleep(0.001)
+            pool.drain()
+        self.assertEqual(results[:2], [0.1, 0])
+        self.assertTrue(isinstance(results[2], clipster.ClipsterError))
+
+    def test_process_fds(self):
+        """Worker processes don't keep the daemon's sockets open."""
+
+        daemon_end, client_end = socket.socketpair()
+        worker = clipster.WorkerProcess(SlowTarget(), 2)
+        self.addCleanup(worker.stop)
+        self.assertEqual(worker.call('sleep', 0), 0)
+        daemon_end.close()
+        client_end.settimeout(2)
+        self.assertEqual(client_end.recv(1), b'')
+        client_end.close()
+
+    def test_process_timeout(self):
+        """Calls which take too long are killed, and the process restarted for the next call."""
+
+        worker = clipster.WorkerProcess(SlowTarget(), 0.2)
+        self.addCleanup(worker.stop)
+        self.assertEqual(worker.call('sleep', 0), 0)
+        with self.assertRaises(ValueError):
+            worker.call('fail')
+        with self.assertRaises(clipster.WorkerTimeout):
+            worker.call('sleep', 5)
+        self.assertEqual(worker.call('sleep', 0.01), 0.01)
+
+
 class ClientTestCase(unittest.TestCase):
     """We mock a socket - however due to the underlying C library, we can't just mock
     socket.socket and get a handle all the way down the stack, so we have to 'know'
@@ -108,11 +455,48 @@ class ClientTestCase(unittest.TestCase):
         client_action = "SELECT"
         self.args.select = True
         self.client = clipster.Client(self.config, self.args)
-        self.client.update()
         # Get a handle to the sock object returned by the mocked socket.socket
         sock = mock_socket.return_value
+        sock.recv.side_effect = frame_chunks(b'null')
+        self.client.update()
         self.assertTrue(mock.call.connect(os.path.join(self.data_dir, socket_file)) in sock.mock_calls)
-        self.assertTrue(mock.call.sendall('{}:{}:0'.format(client_action, board).encode('utf-8')) in sock.mock_calls)
+        self.assertTrue(mock.call.sendall(clipster.encode_request(client_action, board, 0)) in sock.mock_calls)
+
+    @mock.patch('clipster.socket.socket')
+    def test_client_update_error(self, mock_socket):
+        """Are errors returned by the daemon raised by the client?"""
+
+        self.args.select = True
+        client = clipster.Client(self.config, self.args)
+        sock = mock_socket.return_value
+        sock.recv.side_effect = frame_chunks(json.dumps({'error': 'Invalid message.'}).encode('utf-8'))
+        with self.assertRaises(clipster.ClipsterError):
+            client.update()
+
+    @mock.patch('clipster.socket.socket')
+    def test_client_batch(self, mock_socket):
+        """Are batch commands sent over one connection, with a line of output per command?"""
+
+        board = self.config.get('clipster', 'default_selection')
+        commands = ['{"action": "SEND", "content": "ape"}', '', 'not json',
+                    '{"count": 2, "board": "CLIPBOARD"}', '{"count": 0, "stream": true}', '{"action": "STATS"}']
+        sock = mock_socket.return_value
+        streamed = b''.join(clipster.stream_frames(['ape', 'bear'], 65536))
+        mock_stream(sock, b''.join(frame_chunks(b'null') + frame_chunks(b'["ape", "bear"]') + [streamed] + frame_chunks(b'{}')))
+        client = clipster.Client(self.config, self.args)
+        with mock.patch('sys.stdin', io.StringIO(u'\n'.join(commands))):
+            with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+                client.batch()
+        self.assertEqual(mock_socket.call_count, 1)
+        self.assertTrue(mock.call.sendall(clipster.encode_request('SEND', board, 0, 'ape')) in sock.mock_calls)
+        self.assertTrue(mock.call.sendall(clipster.encode_request('BOARD', 'CLIPBOARD', 2)) in sock.mock_calls)
+        output = [json.loads(x) for x in stdout.getvalue().splitlines()]
+        self.assertEqual(output[0], None)
+        self.assertTrue('error' in output[1])
+        self.assertEqual(output[2], ['ape', 'bear'])
+        # Streamed replies are written as one line, and don't desynchronise the connection
+        self.assertEqual(output[3], ['ape', 'bear'])
+        self.assertEqual(output[4], {})
 
     @mock.patch('clipster.socket.socket')
     def test_client_output(self, mock_socket):
@@ -120,26 +504,51 @@ class ClientTestCase(unittest.TestCase):
 
         board = self.config.get('clipster', 'default_selection')
         socket_file = self.config.get('clipster', 'socket_file')
-        client_action = "SELECT"
         # Count isn't actually tested here
         count = 99
         self.args.delim = '\0'
-        self.args.select = True
+        self.args.output = True
         self.args.number = 99
         client = clipster.Client(self.config, self.args)
-        # Describe what recv should expect as a return value
+        # Describe what the socket's file should return
         sock = mock_socket.return_value
-        sock.recv.side_effect = [json.dumps(self.history[board]).encode('utf-8'), ""]
-        # We probably don't need to test for recv, shutdown, close etc, but leave as examples for now
-        output = client.output()
+        sock.makefile.return_value = io.BytesIO(b''.join(frame_chunks(json.dumps(self.history[board]).encode('utf-8'))))
+        out = io.BytesIO()
+        # We probably don't need to test for close etc, but leave as examples for now
+        client.stream_output(out)
 
         self.assertTrue(mock.call.connect(os.path.join(self.data_dir, socket_file)) in sock.mock_calls)
-        self.assertTrue(mock.call.sendall('{}:{}:{}'.format(client_action, board, count).encode('utf-8')) in sock.mock_calls)
-        self.assertTrue(mock.call.shutdown(mock.ANY) in sock.mock_calls)
-        self.assertTrue(mock.call.recv(mock.ANY) in sock.mock_calls)
+        self.assertTrue(mock.call.sendall(clipster.encode_request("BOARD", board, count, None, stream=True))
+                        in sock.mock_calls)
+        self.assertTrue(mock.call.makefile('rb') in sock.mock_calls)
         self.assertTrue(mock.call.close() in sock.mock_calls)
 
-        self.assertEqual(output, '\0'.join(self.history[board]))
+        self.assertEqual(out.getvalue(), '\0'.join(self.history[board]).encode('utf-8'))
+
+    @mock.patch('clipster.socket.socket')
+    def test_client_stream_output(self, mock_socket):
+        """Does the client write streamed entries as they arrive?"""
+
+        board = self.config.get('clipster', 'default_selection')
+        self.args.delim = '\0'
+        self.args.number = 0
+        self.args.position = 1
+        client = clipster.Client(self.config, self.args)
+        records = [clipster.FRAME.pack(clipster.PROTOCOL_VERSION, clipster.FRAME_RECORD, len(x)) + x
+                   for x in (b'two', 'caf\u00e9'.encode('utf-8'))]
+        sock = mock_socket.return_value
+        end = clipster.FRAME.pack(clipster.PROTOCOL_VERSION, clipster.FRAME_END, 0)
+        sock.makefile.return_value = io.BytesIO(b''.join(records) + end)
+        out = io.BytesIO()
+        client.stream_output(out)
+        self.assertTrue(mock.call.sendall(clipster.encode_request('BOARD', board, 0, None, stream=True, position=1))
+                        in sock.mock_calls)
+        self.assertEqual(out.getvalue(), 'two\0caf\u00e9'.encode('utf-8'))
+        # A daemon which doesn't stream sends the whole list
+        sock.makefile.return_value = io.BytesIO(b''.join(frame_chunks(json.dumps(['a', 'b', 'c']).encode('utf-8'))))
+        out = io.BytesIO()
+        client.stream_output(out)
+        self.assertEqual(out.getvalue(), b'b')
 
 
 class DaemonTestCase(unittest.TestCase):
@@ -181,12 +590,46 @@ class DaemonTestCase(unittest.TestCase):
         """Test that pattern matches aren't added to history."""
         self.config.set('clipster', 'ignore_patterns', 'yes')
         board = 'PRIMARY'
-        self.daemon.ignore_patterns = ['^cat$']
+        self.daemon.patterns.load(ignore_patterns=['^cat$', '^d(o)g$', 'x{2}'])
         self.daemon.update_history(board, 'cat')
+        self.daemon.update_history(board, 'dog')
+        self.daemon.update_history(board, 'xx')
         self.daemon.update_history(board, 'placate')
         self.assertTrue('cat' not in self.daemon.boards[board])
+        self.assertTrue('dog' not in self.daemon.boards[board])
+        self.assertTrue('xx' not in self.daemon.boards[board])
         self.assertTrue('placate' in self.daemon.boards[board])
 
+    def test_extract_patterns(self):
+        """Test that extracted patterns are added to history, and extractors don't accumulate."""
+        board = 'PRIMARY'
+        self.daemon.patterns.load(extract_patterns=[r'\d+', '(invalid'])
+        extractors = len(self.daemon.patterns.extractors)
+        self.daemon.update_history(board, 'see http://example.com/ or mail a@example.com 42')
+        self.daemon.update_history(board, 'another 7')
+        self.assertEqual(extractors, len(self.daemon.patterns.extractors))
+        for match in ('http://example.com/', 'a@example.com', '42', '7'):
+            self.assertTrue(match in self.daemon.boards[board])
+        self.assertEqual(self.daemon.boards[board][-1], 'another 7')
+
+    def test_pattern_workers(self):
+        """Test pattern matching in workers, skipping selections which time out if ignore patterns are used."""
+
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.config.set('clipster', 'data_dir', tmp_dir)
+        self.config.set('clipster', 'workers', '2')
+        self.config.set('clipster', 'worker_timeout', '0.5')
+        daemon = clipster.Daemon(self.config)
+        self.addCleanup(daemon.exit)
+        daemon.patterns.load(extract_patterns=[r'\d+'], ignore_patterns=['^(a+)+$'])
+        board = 'PRIMARY'
+        for text in ('cat 42', 'a' * 40 + 'b', 'aaa', 'dog'):
+            daemon.process_selection(board, text)
+        daemon.pattern_pool.drain()
+        self.assertEqual(list(daemon.boards[board]), ['42', 'cat 42', 'dog'])
+        self.assertEqual(daemon.stats.report()['counters']['patterns.errors'], 1)
+
     @mock.patch('clipster.os')
     @mock.patch('clipster.tempfile.NamedTemporaryFile')
     def test_write_history_file_json(self, mock_tmp, mock_os):
@@ -195,7 +638,7 @@ class DaemonTestCase(unittest.TestCase):
         # Set the history size to 2 to check the file is correctly truncated
         self.config.set('clipster', 'history_size', "2")
         # Push the test history to the daemon's in-memory history
-        self.daemon.boards = self.history
+        self.daemon.boards = self.history = {x: clipster.History(y) for x, y in self.history.items()}
         self.daemon.update_history_file = True
         hist_file = self.config.get('clipster', 'history_file')
         # Fake instantiation of context manager
@@ -209,6 +652,150 @@ class DaemonTestCase(unittest.TestCase):
         # Check that there are only 2 items in each list
         self.assertTrue(all(len(x) == 2 for x in saved_history.values()))
 
+    def journal_daemon(self):
+        """Return a daemon using a journal in a temporary data dir."""
+
+        self.config.set('clipster', 'data_dir', self.tmp_dir)
+        self.config.set('clipster', 'history_format', 'journal')
+        daemon = clipster.Daemon(self.config)
+        daemon.read_history_file()
+        return daemon
+
+    def test_journal_round_trip(self):
+        """Test that history changes written to the journal are replayed."""
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        daemon = self.journal_daemon()
+        for text in ('ape', 'bear', 'cat', 'ape'):
+            daemon.update_history('PRIMARY', text)
+        daemon.update_history('CLIPBOARD', 'dog')
+        daemon.remove_history('PRIMARY', 'bear')
+        daemon.write_history_file()
+        daemon.boards['CLIPBOARD'].clear()
+        daemon.update_history_file = True
+        daemon.write_history_file()
+        self.assertFalse(os.path.exists(self.config.get('clipster', 'history_file')))
+        replayed = self.journal_daemon()
+        self.assertEqual(replayed.boards, {'PRIMARY': ['cat', 'ape'], 'CLIPBOARD': []})
+
+    def test_journal_compaction(self):
+        """Test that the journal is compacted once it grows past the size ratio."""
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        daemon = self.journal_daemon()
+        daemon.journal.MIN_COMPACT_SIZE = 0
+        journal = daemon.journal
+        with mock.patch.object(journal, 'start_compaction', wraps=journal.start_compaction) as compact:
+            for i in range(50):
+                daemon.update_history('PRIMARY', 'same {0}'.format(i % 2))
+                daemon.write_history_file()
+            self.assertTrue(compact.called)
+        journal.finish_compaction(wait=True)
+        # Records flushed during a compaction are kept
+        self.assertEqual(self.journal_daemon().boards['PRIMARY'], ['same 0', 'same 1'])
+        # With no flushes during compaction, the journal holds only the live entries
+        journal.start_compaction(daemon.boards, 200)
+        journal.finish_compaction(wait=True)
+        with open(self.config.get('clipster', 'journal_file')) as journal_file:
+            self.assertEqual(len(journal_file.readlines()), 2)
+
+    def test_journal_import_json(self):
+        """Test that an existing JSON history is imported into a new journal."""
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        with open(os.path.join(self.tmp_dir, 'history'), 'w') as hist_file:
+            json.dump(self.history, hist_file)
+        daemon = self.journal_daemon()
+        self.assertEqual(daemon.boards, self.history)
+        self.assertTrue(os.path.exists(self.config.get('clipster', 'journal_file')))
+
+    def test_journal_shared_content(self):
+        """Test that content in both boards is only written to the journal once."""
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        daemon = self.journal_daemon()
+        text = 'shared ' * 100
+        daemon.update_history('PRIMARY', text)
+        daemon.update_history('CLIPBOARD', text)
+        daemon.write_history_file()
+        with open(self.config.get('clipster', 'journal_file')) as journal_file:
+            self.assertEqual([json.loads(x)[0] for x in journal_file], ['add', 'ref'])
+        self.assertEqual(len(daemon.store), 1)
+        replayed = self.journal_daemon()
+        self.assertEqual(replayed.boards, {'PRIMARY': [text], 'CLIPBOARD': [text]})
+        # Compaction writes the content once too
+        replayed.journal.start_compaction(replayed.boards, 200)
+        replayed.journal.finish_compaction(wait=True)
+        replayed.update_history('PRIMARY', text.upper())
+        replayed.write_history_file()
+        self.assertEqual(self.journal_daemon().boards, {'PRIMARY': [text, text.upper()], 'CLIPBOARD': [text]})
+
+    def indexed_daemon(self):
+        """Return a daemon using an indexed history file in a temporary data dir."""
+
+        self.config.set('clipster', 'data_dir', self.tmp_dir)
+        self.config.set('clipster', 'history_format', 'indexed')
+        self.config.set('clipster', 'history_preload', '2')
+        daemon = clipster.Daemon(self.config)
+        daemon.read_history_file()
+        return daemon
+
+    def test_indexed_history(self):
+        """Test that the indexed file is loaded lazily, and rewritten."""
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        with open(os.path.join(self.tmp_dir, 'history'), 'w') as hist_file:
+            json.dump({'PRIMARY': ['ape', 'bear', 'caf\u00e9', 'dog'], 'CLIPBOARD': ['dog']}, hist_file)
+        # Import the JSON history
+        daemon = self.indexed_daemon()
+        self.assertTrue(daemon.update_history_file)
+        daemon.write_history_file()
+        daemon = self.indexed_daemon()
+        # Only the 2 most recent entries of each board have been read
+        self.assertEqual(daemon.store.counters()['mapped'], 2)
+        self.assertEqual(daemon.boards['PRIMARY'].latest(2), ['dog', 'caf\u00e9'])
+        self.assertEqual(daemon.store.counters()['mapped'], 2)
+        # Searching and streaming read entries without keeping them, but index them
+        primary = daemon.boards['PRIMARY']
+        self.assertEqual(len(primary.search_index.unindexed), 2)
+        self.assertEqual(primary.search('be', 1), ['bear'])
+        self.assertEqual(list(primary.iter_latest(0)), ['dog', 'caf\u00e9', 'bear', 'ape'])
+        self.assertEqual(daemon.store.counters()['mapped'], 2)
+        self.assertEqual(len(primary.search_index.unindexed), 0)
+        self.assertEqual(primary.search_index.candidates('ape'), set([primary.entry_ids()[0]]))
+        self.assertEqual(primary.get(primary.entry_ids()[0], keep=False), 'ape')
+        self.assertEqual(daemon.store.counters()['mapped'], 2)
+        self.assertEqual(primary.get(primary.entry_ids()[1]), 'bear')
+        self.assertEqual(daemon.store.counters()['mapped'], 1)
+        # Mapped entries are copied to the new file
+        daemon.update_history('PRIMARY', 'eel')
+        daemon.write_history_file()
+        self.assertEqual(daemon.boards['PRIMARY'], ['ape', 'bear', 'caf\u00e9', 'dog', 'eel'])
+        daemon = self.indexed_daemon()
+        self.assertEqual(daemon.boards, {'PRIMARY': ['ape', 'bear', 'caf\u00e9', 'dog', 'eel'], 'CLIPBOARD': ['dog']})
+        self.assertEqual(len(daemon.store), 5)
+
+    def test_memory_budget(self):
+        """Test that entry_max_bytes and board_max_bytes limit the history."""
+
+        self.config.set('clipster', 'entry_max_bytes', '20')
+        self.config.set('clipster', 'board_max_bytes', '30')
+        self.daemon.reload()
+        self.daemon.update_history('PRIMARY', 'x' * 21)
+        self.assertEqual(self.daemon.boards['PRIMARY'], [])
+        for text in ('one' * 5, 'two' * 5, 'three' * 3):
+            self.daemon.update_history('PRIMARY', text)
+        self.assertEqual(self.daemon.boards['PRIMARY'], ['two' * 5, 'three' * 3])
+        self.assertEqual(self.daemon.stats_report()['boards']['PRIMARY']['evicted'], 1)
+        self.config.set('clipster', 'eviction_policy', 'newest')
+        with self.assertRaises(clipster.ClipsterError):
+            self.daemon.apply_budget()
+
     def test_read_board(self):
         """Test reading from a previously set clipboard."""
         msg = "clipster test text."
@@ -223,6 +810,27 @@ class DaemonTestCase(unittest.TestCase):
         primary = Gtk.Clipboard.get(Gdk.SELECTION_PRIMARY)
         self.assertEqual(msg, primary.wait_for_text())
 
+    def test_shadow_board(self):
+        """Test that the daemon's own selection changes are known without reading the selection."""
+
+        shadow = self.daemon.shadow
+        self.daemon.update_board('PRIMARY', 'ours')
+        with mock.patch.object(self.daemon.primary, 'wait_for_text', return_value='ours') as wait:
+            # Until our owner-change event arrives, the selection is read
+            self.assertEqual(self.daemon.read_board('PRIMARY'), 'ours')
+            shadow.changed('PRIMARY')
+            for _ in range(3):
+                self.assertEqual(self.daemon.read_board('primary'), 'ours')
+            self.assertEqual(wait.call_count, 1)
+            # Another app owns the selection
+            shadow.changed('PRIMARY')
+            wait.return_value = 'theirs'
+            self.assertEqual(self.daemon.read_board('PRIMARY'), 'theirs')
+            self.assertEqual(self.daemon.read_board('PRIMARY'), 'theirs')
+            self.assertEqual(wait.call_count, 2)
+        counters = self.daemon.stats.report()['counters']
+        self.assertEqual((counters['shadow.hits'], counters['shadow.misses']), (4, 2))
+
     def test_remove_history_no_item(self):
         """Test removing an item from the history that isn't there."""
         self.daemon.remove_history('PRIMARY', 'apple')
@@ -230,13 +838,14 @@ class DaemonTestCase(unittest.TestCase):
     def test_remove_history(self):
         """Test removing an item from the history."""
         board = 'PRIMARY'
-        self.daemon.boards = self.history
+        self.daemon.boards = self.history = {x: clipster.History(y) for x, y in self.history.items()}
         self.daemon.remove_history(board, 'apple')
         self.assertFalse('apple' in self.daemon.boards[board])
 
     def test_duplicates_no(self):
         """Test not allowing duplicates in history."""
         self.config.set('clipster', 'duplicates', 'no')
+        self.daemon.reload()
         board = 'PRIMARY'
         self.daemon.update_history(board, 'copy')
         self.daemon.update_history(board, 'copy')
@@ -246,6 +855,7 @@ class DaemonTestCase(unittest.TestCase):
         """Test allowing duplicates in history."""
         self.config.set('clipster', 'smart_update', '1000')
         self.config.set('clipster', 'duplicates', 'yes')
+        self.daemon.reload()
         board = 'PRIMARY'
         self.daemon.update_history(board, 'copy')
         self.daemon.update_history(board, 'copy')
@@ -254,6 +864,7 @@ class DaemonTestCase(unittest.TestCase):
     def test_smart_update(self):
         """Test that smart update works from left to right."""
         self.config.set('clipster', 'smart_update', '1')
+        self.daemon.reload()
         board = 'PRIMARY'
         # Select 'forwards'
         self.daemon.update_history(board, 'ye')
@@ -263,6 +874,7 @@ class DaemonTestCase(unittest.TestCase):
     def test_smart_update_disable(self):
         """Test that smart update is disabled by setting to 0."""
         self.config.set('clipster', 'smart_update', '0')
+        self.daemon.reload()
         board = 'PRIMARY'
         # Select 'forwards'
         self.daemon.update_history(board, 'ye')
@@ -272,6 +884,7 @@ class DaemonTestCase(unittest.TestCase):
     def test_smart_update_backwards(self):
         """Test that smart_update works when selecting from right to left."""
         self.config.set('clipster', 'smart_update', '1')
+        self.daemon.reload()
         board = 'PRIMARY'
         # Select 'backwards'
         self.daemon.update_history(board, 'o')
@@ -281,6 +894,7 @@ class DaemonTestCase(unittest.TestCase):
     def test_smart_update_limit(self):
         """Test that selection 'extends' greater than smart_update limit are ignored."""
         self.config.set('clipster', 'smart_update', '1')
+        self.daemon.reload()
         board = 'PRIMARY'
         # Extend selection by several chars
         self.daemon.update_history(board, 'short')
@@ -297,11 +911,11 @@ class DaemonTestCase(unittest.TestCase):
         # so that total length (plus header) exceeds it.
         text = "x" * max_input
         conn = mock_socket.connect
-        # Make mock conn.recv simulate bufsize 'trimming'
-        conn.recv.side_effect = lambda l: (header + text)[:l]
+        # Make mock conn.recv read from the message, honouring bufsize
+        mock_stream(conn, (header + text).encode('utf-8'))
         # Set up a fake conn fileno and client_msgs dictionary
         conn.fileno.return_value = 0
-        self.daemon.client_msgs = {0: []}
+        self.daemon.client_msgs = {0: clipster.ClientConnection(conn, max_input)}
         while True:
             if not self.daemon.socket_recv(conn, None):
                 break
@@ -309,9 +923,95 @@ class DaemonTestCase(unittest.TestCase):
         # check that text length has been trimmed to max_input
         self.assertEqual(len(header) + len(text), max_input)
 
+    def test_framed_messages(self):
+        """Test that several framed messages can be sent on one connection."""
+
+        conn = mock.MagicMock()
+        conn.fileno.return_value = 0
+        text = 'caf\u00e9 ' * 5000
+        requests = [clipster.encode_request('SEND', 'PRIMARY', content=text),
+                    clipster.encode_request('BOARD', 'PRIMARY', 1)]
+        output = mock_stream(conn, b''.join(requests))
+        self.daemon.client_msgs = {0: clipster.ClientConnection(conn, 50000)}
+        while self.daemon.socket_recv(conn, None):
+            pass
+        self.assertEqual(text, Gtk.Clipboard.get(Gdk.SELECTION_PRIMARY).wait_for_text())
+        # Each framed message gets a reply: null for SEND, the history for BOARD
+        replies = [x[1] for x in clipster.read_frames(io.BytesIO(output.getvalue()))]
+        self.assertEqual(replies[0], b'null')
+        self.assertEqual(json.loads(replies[1].decode('utf-8')), [])
+        self.assertTrue(conn.close.called)
+        self.assertEqual(self.daemon.client_msgs, {})
+
+    def test_client_backpressure(self):
+        """Test that replies are sent as the socket accepts them, and that a
+        client's next request waits until a streamed reply has been sent."""
+
+        self.daemon.boards = {x: clipster.History(y) for x, y in self.history.items()}
+        conn = mock.MagicMock()
+        conn.fileno.return_value = 0
+        requests = [clipster.encode_request('BOARD', 'PRIMARY', 0, stream=True),
+                    clipster.encode_request('BOARD', 'CLIPBOARD', 1)]
+        mock_stream(conn, b''.join(requests))
+        output = io.BytesIO()
+        calls = []
+
+        def send(data):
+            # A slow reader: every other send would block, the rest take 7 bytes
+            calls.append(len(data))
+            if len(calls) % 2:
+                raise clipster.socket.error(errno.EAGAIN, "Resource temporarily unavailable")
+            return output.write(bytes(data[:7]))
+
+        conn.send.side_effect = send
+        client = self.daemon.client_msgs[0] = clipster.ClientConnection(conn, 50000)
+        self.daemon.update_watches(client)
+        self.assertTrue(self.daemon.socket_recv(conn, None))
+        # The stream request has been read: wait for it to be sent before reading more
+        self.assertFalse(self.daemon.socket_recv(conn, None))
+        self.assertTrue(client.busy())
+        self.assertEqual((client.in_watch, bool(client.out_watch)), (None, True))
+        for _ in range(1000):
+            if conn.close.called:
+                break
+            if client.out_watch:
+                self.daemon.socket_send(conn, None)
+            else:
+                self.daemon.socket_recv(conn, None)
+        frames = list(clipster.read_frames(io.BytesIO(output.getvalue())))
+        self.assertEqual([x[1] for x in frames[:4]], [b'clementine\nclementine\n', b'banana\nbanana', b'apple', b''])
+        self.assertEqual(frames[4], (clipster.FRAME_MSG, b'["cat\\ncat\\n"]'))
+        self.assertTrue(conn.close.called)
+        self.assertEqual(self.daemon.client_msgs, {})
+
+    def test_client_limits(self):
+        """Test that connections beyond max_clients wait, and idle connections are closed."""
+
+        self.config.set('clipster', 'max_clients', '2')
+        self.config.set('clipster', 'client_timeout', '10')
+        self.daemon.sock = listener = mock.MagicMock()
+        conns = [mock.MagicMock() for _ in range(2)]
+        for fileno, conn in enumerate(conns):
+            conn.fileno.return_value = fileno
+        listener.accept.side_effect = [(x, None) for x in conns]
+        self.assertTrue(self.daemon.socket_accept(listener, None))
+        self.assertFalse(self.daemon.socket_accept(listener, None))
+        conns[0].setblocking.assert_called_with(False)
+        self.assertEqual(self.daemon.accept_watch, None)
+        self.daemon.client_msgs[0].last_active -= 20
+        self.daemon.expire_clients()
+        self.assertTrue(conns[0].close.called)
+        self.assertFalse(conns[1].close.called)
+        self.assertEqual(list(self.daemon.client_msgs), [1])
+        # Accepting again
+        self.assertNotEqual(self.daemon.accept_watch, None)
+        counters = self.daemon.stats.report()['counters']
+        self.assertEqual((counters['clients.deferred'], counters['clients.timeouts']), (1, 1))
+
     def test_sync_selections(self):
         """Test that sync_selections syncs between boards."""
         self.config.set('clipster', 'sync_selections', 'yes')
+        self.daemon.reload()
         text = '100°C'
         self.daemon.update_history('PRIMARY', text)
         clipboard = Gtk.Clipboard.get(Gdk.SELECTION_CLIPBOARD)
@@ -324,8 +1024,7 @@ class DaemonTestCase(unittest.TestCase):
         # Set up a mock of some of a socket connection object
         conn = mock.MagicMock()
         conn.fileno.return_value = 1
-        self.daemon.client_msgs = {1: "INVALID MESSAGE"}
-        self.daemon.process_msg(conn)
+        self.daemon.process_msg(conn, "INVALID MESSAGE")
         mock_logging.assert_called_with('Invalid message received via socket: %s', 'INVALID MESSAGE')
 
     @mock.patch('clipster.Daemon.update_board')
@@ -340,29 +1039,144 @@ class DaemonTestCase(unittest.TestCase):
         board = 'PRIMARY'
         count = '0'
         msg = 'Hello world\n'
-        self.daemon.client_msgs = {1: '{}:{}:{}:{}'.format(action, board, count, msg)}
-        self.daemon.process_msg(conn)
+        self.daemon.process_msg(conn, '{}:{}:{}:{}'.format(action, board, count, msg))
         mock_update_board.assert_called_with(board, msg)
 
     @mock.patch('clipster.Daemon.update_board')
     def test_process_msg_output(self, mock_update_board):
         """Process a client message to output a board's contents."""
 
-        # Set up a mock of some of a socket connection object
+        # Set up a client connection on a mock socket
         conn = mock.MagicMock()
-        conn.fileno.return_value = 1
-        conn.sendall.return_value = True
-        self.daemon.boards = self.history
+        output = mock_stream(conn, b'')
+        client = clipster.ClientConnection(conn, 50000)
+        self.daemon.boards = self.history = {x: clipster.History(y) for x, y in self.history.items()}
 
         action = 'BOARD'
         board = 'PRIMARY'
         count = 1
-        self.daemon.client_msgs = {1: '{}:{}:{}'.format(action, board, count)}
-        self.daemon.process_msg(conn)
-        args, kwargs = conn.sendall.call_args
-        msg_list = json.loads(args[0].decode('utf-8'))
+        self.daemon.process_msg(client, '{}:{}:{}'.format(action, board, count))
+        client.send()
+        msg_list = json.loads(output.getvalue().decode('utf-8'))
         self.assertListEqual(self.history[board][-count:], msg_list)
 
+    def test_process_msg_search(self):
+        """Process a framed client message searching a board."""
+
+        client, frames = mock_client()
+        self.daemon.boards = self.history = {x: clipster.History(y) for x, y in self.history.items()}
+        msg = json.dumps({'action': 'BOARD', 'board': 'PRIMARY', 'count': 0, 'mode': 'literal', 'icase': True})
+        self.daemon.process_msg(client, msg + '\nBANANA', framed=True)
+        self.daemon.process_msg(client, msg.replace('literal', 'regex') + '\n(invalid', framed=True)
+        replies = [json.loads(x[1].decode('utf-8')) for x in frames()]
+        self.assertEqual(replies[0], ['banana\nbanana'])
+        self.assertTrue('error' in replies[1])
+
+    def test_process_msg_stream(self):
+        """Process a framed client message requesting a streamed reply."""
+
+        self.daemon.boards = self.history = {x: clipster.History(y) for x, y in self.history.items()}
+        for position, expected in ((None, ['clementine\nclementine\n', 'banana\nbanana', 'apple']),
+                                   (1, ['banana\nbanana']), (-1, ['apple']), (3, [])):
+            client, sent = mock_client()
+            msg = json.dumps({'action': 'BOARD', 'board': 'PRIMARY', 'count': 3, 'stream': True, 'position': position})
+            self.daemon.process_msg(client, msg, framed=True)
+            # The stream is produced as it is sent
+            self.assertTrue(client.busy())
+            frames = sent()
+            self.assertEqual(frames[-1], (clipster.FRAME_END, b''))
+            self.assertEqual([x[1].decode('utf-8') for x in frames[:-1]], expected)
+            self.assertTrue(all(x[0] == clipster.FRAME_RECORD for x in frames[:-1]))
+
+    def test_process_msg_stats(self):
+        """Process a framed client message requesting statistics."""
+
+        client, frames = mock_client()
+        self.daemon.update_history('PRIMARY', 'stats')
+        msg = json.dumps({'action': 'STATS', 'board': 'PRIMARY', 'count': 0})
+        self.daemon.process_msg(client, msg, framed=True)
+        self.daemon.process_msg(client, msg, framed=True)
+        report = json.loads(frames()[1][1].decode('utf-8'))
+        self.assertEqual(report['timings']['update_history']['count'], 1)
+        self.assertEqual(report['timings']['process_msg.STATS']['count'], 1)
+        self.assertEqual(report['counters']['history.added'], 1)
+        self.assertEqual(report['boards']['PRIMARY']['items'], len(self.daemon.boards['PRIMARY']))
+
+    def test_process_msg_reload(self):
+        """Process a framed client message to reload the config, keeping the history."""
+
+        conf_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, conf_dir)
+        conf_file = os.path.join(conf_dir, 'clipster.ini')
+        with open(os.path.join(conf_dir, 'ignore_patterns'), 'w') as patt_file:
+            patt_file.write('^secret')
+        self.args.config = conf_dir
+        daemon = clipster.Daemon(self.config, lambda: clipster.parse_config(self.args, self.data_dir, self.conf_dir))
+        daemon.update_history('PRIMARY', 'secret one')
+        with open(conf_file, 'w') as ini:
+            ini.write("[clipster]\nduplicates = yes\nignore_patterns = yes\nsocket_file = /elsewhere\n")
+        client, frames = mock_client()
+        msg = json.dumps({'action': 'RELOAD', 'board': 'PRIMARY', 'count': 0})
+        daemon.process_msg(client, msg, framed=True)
+        self.assertEqual(frames()[0][1], b'null')
+        self.assertTrue(daemon.settings.duplicates)
+        # Only read at startup
+        self.assertEqual(daemon.config.get('clipster', 'socket_file'), self.config.get('clipster', 'socket_file'))
+        daemon.update_history('PRIMARY', 'secret two')
+        self.assertEqual(daemon.boards['PRIMARY'], ['secret one'])
+        # An invalid config is reported, and the current one kept
+        with open(conf_file, 'w') as ini:
+            ini.write("[clipster]\nduplicates = no\nsmart_update = some\n")
+        daemon.process_msg(client, msg, framed=True)
+        self.assertTrue(b'Invalid config' in frames()[1][1])
+        self.assertTrue(daemon.settings.duplicates)
+        # Options outside the settings are checked too, before anything is changed
+        for invalid in ("eviction_policy = biggest", "history_size = lots", "max_clients = many"):
+            with open(conf_file, 'w') as ini:
+                ini.write("[clipster]\nrow_height = 9\n{0}\n".format(invalid))
+            with self.assertRaises(clipster.ClipsterError):
+                daemon.reload()
+            self.assertEqual(daemon.settings.row_height, 3)
+            self.assertEqual(daemon.config.get('clipster', 'history_size'), '200')
+
+    @mock.patch.object(clipster.Daemon, 'write_history_file')
+    def test_flush_history(self, mock_write):
+        """The periodic history flush follows write_on_change, as reloaded."""
+
+        self.daemon.flush_history()
+        self.assertEqual(mock_write.call_count, 1)
+        self.config.set('clipster', 'write_on_change', 'yes')
+        self.daemon.reload()
+        self.assertTrue(self.daemon.flush_history())
+        self.assertEqual(mock_write.call_count, 1)
+
+    def test_trace(self):
+        """Selections and client requests are recorded to the trace file, with content if enabled."""
+
+        trace_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, trace_dir)
+        trace_file = os.path.join(trace_dir, 'trace')
+        self.config.set('clipster', 'trace_file', trace_file)
+        daemon = clipster.Daemon(self.config)
+        client, _ = mock_client()
+        daemon.process_selection('PRIMARY', 'secret')
+        daemon.process_msg(client, json.dumps({'action': 'BOARD', 'board': 'CLIPBOARD', 'count': 2, 'stream': True}), framed=True)
+        # Enabling content (on reload) starts a new trace
+        self.config.set('clipster', 'trace_content', 'yes')
+        daemon.reload()
+        daemon.process_selection('CLIPBOARD', 'plain')
+        daemon.tracer.close()
+        with open(trace_file) as trace:
+            events = [json.loads(x) for x in trace]
+        self.assertEqual([x['event'] for x in events], ['start', 'selection', 'request', 'start', 'selection'])
+        self.assertEqual(events[1]['digest'], clipster.content_digest('secret'))
+        self.assertEqual(events[1]['size'], 6)
+        self.assertFalse('text' in events[1])
+        self.assertEqual((events[2]['action'], events[2]['board'], events[2]['count']), ('BOARD', 'CLIPBOARD', 2))
+        self.assertEqual(events[2]['options'], {'stream': True})
+        self.assertEqual(events[4]['text'], 'plain')
+        self.assertEqual(daemon.boards['PRIMARY'][-1], 'secret')
+
     def test_process_msg_delete_last(self):
         """Process a client message to delete the last item from a board."""
 
@@ -370,14 +1184,13 @@ class DaemonTestCase(unittest.TestCase):
         conn = mock.MagicMock()
         conn.fileno.return_value = 1
         conn.sendall.return_value = True
-        self.daemon.boards = self.history
+        self.daemon.boards = self.history = {x: clipster.History(y) for x, y in self.history.items()}
 
         action = 'DELETE'
         board = 'PRIMARY'
         board_length = len(self.history[board])
         count = 1
-        self.daemon.client_msgs = {1: '{}:{}:{}'.format(action, board, count)}
-        self.daemon.process_msg(conn)
+        self.daemon.process_msg(conn, '{}:{}:{}'.format(action, board, count))
         # Board should be one item less
         self.assertEqual(board_length - len(self.history[board]), 1)
 
@@ -388,15 +1201,14 @@ class DaemonTestCase(unittest.TestCase):
         conn = mock.MagicMock()
         conn.fileno.return_value = 1
         conn.sendall.return_value = True
-        self.daemon.boards = self.history
+        self.daemon.boards = self.history = {x: clipster.History(y) for x, y in self.history.items()}
 
         action = 'DELETE'
         board = 'PRIMARY'
         count = 1
         pattern = "apple"
         board_length = len(self.history[board])
-        self.daemon.client_msgs = {1: '{}:{}:{}:{}'.format(action, board, count, pattern)}
-        self.daemon.process_msg(conn)
+        self.daemon.process_msg(conn, '{}:{}:{}:{}'.format(action, board, count, pattern))
         # Board should be one item less
         self.assertEqual(board_length - len(self.history[board]), 1)
 
@@ -407,15 +1219,14 @@ class DaemonTestCase(unittest.TestCase):
         conn = mock.MagicMock()
         conn.fileno.return_value = 1
         conn.sendall.return_value = True
-        self.daemon.boards = self.history
+        self.daemon.boards = self.history = {x: clipster.History(y) for x, y in self.history.items()}
 
         action = 'DELETE'
         board = 'PRIMARY'
         count = 1
         pattern = "notinhistory"
         board_length = len(self.history[board])
-        self.daemon.client_msgs = {1: '{}:{}:{}:{}'.format(action, board, count, pattern)}
-        self.daemon.process_msg(conn)
+        self.daemon.process_msg(conn, '{}:{}:{}:{}'.format(action, board, count, pattern))
         # Board should be one item less
         self.assertEqual(board_length, len(self.history[board]))
 
@@ -426,16 +1237,48 @@ class DaemonTestCase(unittest.TestCase):
         conn = mock.MagicMock()
         conn.fileno.return_value = 1
         conn.sendall.return_value = True
-        self.daemon.boards = self.history
+        self.daemon.boards = self.history = {x: clipster.History(y) for x, y in self.history.items()}
 
         action = 'ERASE'
         board = 'PRIMARY'
         count = 1
-        self.daemon.client_msgs = {1: '{}:{}:{}'.format(action, board, count)}
-        self.daemon.process_msg(conn)
+        self.daemon.process_msg(conn, '{}:{}:{}'.format(action, board, count))
         # Board should be empty
         self.assertEqual(len(self.history[board]), 0)
 
+    def test_make_label(self):
+        """Test that selection window labels are escaped and truncated."""
+
+        self.assertEqual(clipster.make_label("a<b", 3), "a&lt;b")
+        # One more line than row_height isn't truncated
+        self.assertEqual(clipster.make_label("1\n2\n3\n4", 3), "1\n2\n3\n4")
+        self.assertEqual(clipster.make_label("1\n2\n3\n4\n5\n", 3), "1\n2\n3\n<b><i>(2 more lines)</i></b>")
+        self.assertEqual(clipster.make_label("x" * 20, 3, max_chars=10), "x" * 10 + "...")
+
+    def test_picker_label_boards(self):
+        """Cached labels should not be shared between boards' entries with the same id."""
+
+        self.daemon.update_history('PRIMARY', 'primary text')
+        self.daemon.update_history('CLIPBOARD', 'clipboard text')
+        primary_id = self.daemon.boards['PRIMARY'].entry_ids()[0]
+        clipboard_id = self.daemon.boards['CLIPBOARD'].entry_ids()[0]
+        self.assertEqual(primary_id, clipboard_id)
+        self.assertEqual(self.daemon.picker_label('PRIMARY', primary_id), 'primary text')
+        self.assertEqual(self.daemon.picker_label('CLIPBOARD', clipboard_id), 'clipboard text')
+
+    def test_picker_label_cached(self):
+        """Entries with cached labels should not be read again, and removed entries should be skipped."""
+
+        self.daemon.update_history('PRIMARY', 'some text')
+        history = self.daemon.boards['PRIMARY']
+        entry_id = history.entry_ids()[0]
+        self.assertEqual(self.daemon.picker_label('PRIMARY', entry_id), 'some text')
+        with mock.patch.object(history, 'get') as mock_get:
+            self.assertEqual(self.daemon.picker_label('PRIMARY', entry_id), 'some text')
+        mock_get.assert_not_called()
+        history.remove('some text')
+        self.assertRaises(KeyError, self.daemon.picker_label, 'PRIMARY', entry_id)
+
     def test_get_list_from_option_string(self):
         """Test parsing comma separated option string from the config file."""
 
@@ -453,23 +1296,67 @@ class DaemonTestCase(unittest.TestCase):
         self.assertNotEqual(clipster.Wnck, None)
         self.daemon = clipster.Daemon(self.config)
         # unnecessary assertion, already tested in the previous test above
-        self.assertEqual(self.daemon.blacklist_classes, ['thunar', 'chromium', 'kate'])
-        self.assertEqual(self.daemon.whitelist_classes, ['subl3'])
+        self.assertEqual(self.daemon.blacklist_classes, {'thunar', 'chromium', 'kate'})
+        self.assertEqual(self.daemon.whitelist_classes, {'subl3'})
 
-    @mock.patch('clipster.get_wm_class_from_active_window')
-    def test_filtered_window_classes(self, mock_class):
+    def test_owner_change_coalesce(self):
+        """Test that owner-change events during a capture are coalesced into one more capture."""
+
+        board = self.daemon.primary
+        mock_event = mock.MagicMock()
+        mock_event.selection = "PRIMARY"
+        self.daemon.window = Gtk.Window(type=Gtk.WindowType.POPUP)
+        with mock.patch.object(self.daemon, 'button_held', return_value=False):
+            with mock.patch.object(board, 'request_text') as request_text:
+                for _ in range(5):
+                    self.daemon.owner_change(board, mock_event)
+                self.assertEqual(request_text.call_count, 1)
+                self.assertTrue(self.daemon.capture_pending["PRIMARY"])
+                self.daemon.text_received(board, "first", "PRIMARY")
+                # Coalesced events trigger a single new capture
+                self.assertEqual(request_text.call_count, 2)
+                self.daemon.text_received(board, "second", "PRIMARY")
+        self.assertEqual(self.daemon.capture_state["PRIMARY"], 'idle')
+        self.assertEqual(self.daemon.boards["PRIMARY"][-1], "second")
+
+    @mock.patch('clipster.GLib.timeout_add')
+    @mock.patch('clipster.GLib.source_remove')
+    def test_capture_debounce(self, mock_remove, mock_timeout):
+        """Test that a burst of captured selections is processed once, with the last value."""
+
+        process = mock.MagicMock()
+        capture = clipster.CapturePipeline(100, process)
+        for text in ('a', 'ab', 'abc'):
+            capture.submit('PRIMARY', text)
+        capture.submit('CLIPBOARD', 'x')
+        self.assertFalse(process.called)
+        self.assertEqual(mock_remove.call_count, 2)
+        capture.fire('PRIMARY')
+        process.assert_called_once_with('PRIMARY', 'abc')
+        capture.flush()
+        process.assert_called_with('CLIPBOARD', 'x')
+        self.assertEqual(capture.counters(), {'events': 4, 'coalesced': 2, 'processed': 2, 'pending': 0})
+
+    def test_filtered_window_classes(self):
         """Test that blacklist/whitelist properly disables/enables capturing
-        clipboard content into history. 
+        clipboard content into history.
         Note: blacklist has precedence over whitelist."""
 
         self.daemon.window = Gtk.Window(type=Gtk.WindowType.POPUP)
         self.daemon.p_id = self.daemon.primary.connect('owner-change',
                                                        self.daemon.owner_change)
         self.daemon.c_id = self.daemon.clipboard.connect('owner-change',
-                                                        self.daemon.owner_change)
-
-        self.daemon.blacklist_classes = ['thunar', 'chromium', 'kate', 'catfish']
-        self.daemon.whitelist_classes = ['subl3', 'catfish']
+                                                         self.daemon.owner_change)
+
+        # The active window's class is tracked from Wnck signals
+        screen = mock.MagicMock()
+        window = screen.get_active_window.return_value
+        window.get_class_group_name.return_value = 'Thunar'
+        tracker = clipster.WindowTracker(screen, {'subl3', 'catfish'}, {'thunar', 'chromium', 'kate', 'catfish'})
+        screen.connect.assert_called_once_with('active-window-changed', tracker.active_window_changed)
+        window.connect.assert_called_once_with('class-changed', tracker.class_changed)
+        self.assertTrue(tracker.ignore)
+        self.daemon.window_tracker = tracker
 
         wm_classes = iter((('subl3', False), ('firefox', True),
                            ('chromium', True), ('catfish', True)))
@@ -478,21 +1365,22 @@ class DaemonTestCase(unittest.TestCase):
             """For each mock test_class, if it should be filtered out, the test
             string should not be found in the clipboard history."""
 
-            self.daemon.boards = {"PRIMARY": [], "CLIPBOARD": []}
+            self.daemon.boards = {"PRIMARY": clipster.History(), "CLIPBOARD": clipster.History()}
             test_string = "testing with class " + test_class
-            mock_class.return_value=test_class
+            window.get_class_group_name.return_value = test_class
+            tracker.class_changed(window)
             self.daemon.primary.set_text(test_string, -1)
 
             self.assertEqual(test_string, self.daemon.primary.wait_for_text())
             self.assertEqual(test_string, self.daemon.read_board('primary'))
 
-            mock_event = mock.MagicMock() #Gdk.EventOwnerChange
+            mock_event = mock.MagicMock()  # Gdk.EventOwnerChange
             mock_event.selection = "PRIMARY"
 
             self.daemon.owner_change(self.daemon.primary, mock_event)
-
-            # Only works in >= 3.6
-            # mock_class.assert_called() # debug
+            # Wait for the (asynchronous) capture to finish
+            while self.daemon.capture_state["PRIMARY"] != 'idle':
+                Gtk.main_iteration()
 
             if filtered_out:
                 self.assertNotIn(test_string, self.daemon.boards["PRIMARY"])
@@ -502,5 +1390,6 @@ class DaemonTestCase(unittest.TestCase):
         for test_class in wm_classes:
             test_owner_change_event(test_class[0], test_class[1])
 
+
 if __name__ == "__main__":
     unittest.main()